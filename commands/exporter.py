@@ -1,14 +1,23 @@
 import argparse
 import os
 import json
+import tempfile
 from urllib.parse import urlparse
 from slugify import slugify
 import logging
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from metabasepy.client import Client, AuthorizationFailedException
+from metabasepy.compression import compressed_path, open_output
 
 logger = logging.getLogger(__name__)
 
+JOURNAL_FILE_NAME = ".export_journal"
+
 
 def create_dir(dirname):
     try:
@@ -17,6 +26,108 @@ def create_dir(dirname):
         pass
 
 
+def default_file_mode():
+    """ Mode open() would give a new file under the current umask. """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def atomic_write(path, content, compression=None):
+    """ Write content next to path in a temporary file and rename it over
+    path, so readers never see a partially written file. """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    os.close(fd)
+    try:
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_path, default_file_mode())
+        with open_output(tmp_path, compression) as f:
+            f.write(content.encode('utf-8'))
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ExportJournal(object):
+    """ Append-only record of exported cards.
+
+    Every finished card is appended as one json line after its file has been
+    renamed into place, so the journal never mentions a card whose file is
+    incomplete. Several processes may append to the same journal. """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = set()
+        if resume:
+            self.load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            content = f.read()
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # torn line from an interrupted run
+                continue
+            self.completed.add(entry.get('card_id'))
+        if content and not content.endswith("\n"):
+            # terminate the torn line so new entries start on their own line
+            with open(self.path, 'a') as f:
+                f.write("\n")
+
+    def is_done(self, card_id):
+        return card_id in self.completed
+
+    def mark_done(self, card_id, path):
+        line = json.dumps({"card_id": card_id, "path": path}) + "\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line.encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self.completed.add(card_id)
+
+
+def export_card(card_info, directory, journal, worker_index=0,
+                worker_count=1, compression=None):
+    card_id = card_info.get('id')
+    if card_id is not None and card_id % worker_count != worker_index:
+        # another worker owns this card
+        return
+    if journal.is_done(card_id):
+        return
+
+    card_name = slugify(card_info.get('name', "Question"))
+    try:
+        sql_query = card_info['dataset_query']['native']['query']
+    except KeyError as ke:
+        # Probably this is not a native query, skip this
+        logger.error(ke)
+        return
+
+    sql_save_path = compressed_path(
+        os.path.join(directory, "{}.sql".format(card_name)), compression)
+    atomic_write(sql_save_path, sql_query, compression=compression)
+    journal.mark_done(card_id, sql_save_path)
+
+
 def download_cards(username, password, base_url, destination_directory,
                    **kwargs):
     cli = Client(username=username, password=password, base_url=base_url)
@@ -24,24 +135,22 @@ def download_cards(username, password, base_url, destination_directory,
 
     create_dir(destination_directory)
 
+    journal = ExportJournal(
+        path=os.path.join(destination_directory, JOURNAL_FILE_NAME),
+        resume=kwargs.get('resume', False))
+    worker_index = kwargs.get('worker_index', 0)
+    worker_count = kwargs.get('worker_count', 1)
+    compression = kwargs.get('compression')
+
     all_collections = cli.collections.get()
     if not all_collections:
         # save all cards for one default collection
         default_collection_path = os.path.join(destination_directory, "default")
         create_dir(default_collection_path)
         for card_info in cli.cards.get():
-            card_name = slugify(card_info.get('name', "Question"))
-            try:
-                sql_query = card_info['dataset_query']['native']['query']
-            except KeyError as ke:
-                # Probably this is not a native query, skip this
-                logger.error(ke)
-                continue
-
-            sql_save_path = os.path.join(default_collection_path,
-                                         "{}.sql".format(card_name))
-            with open(sql_save_path, 'w') as f:
-                f.write(sql_query)
+            export_card(card_info, default_collection_path, journal,
+                        worker_index=worker_index, worker_count=worker_count,
+                        compression=compression)
     else:
         for collection_data in all_collections:
             collection_directory = os.path.join(destination_directory,
@@ -50,18 +159,10 @@ def download_cards(username, password, base_url, destination_directory,
 
             for card_info in cli.cards.get_by_collection(
                     collection_data.get('slug')):
-                card_name = slugify(card_info.get('name', "Question"))
-                try:
-                    sql_query = card_info['dataset_query']['native']['query']
-                except KeyError as ke:
-                    # Probably this is not a native query, skip this
-                    logger.error(ke)
-                    continue
-
-                sql_save_path = os.path.join(collection_directory,
-                                             "{}.sql".format(card_name))
-                with open(sql_save_path, 'w') as f:
-                    f.write(sql_query)
+                export_card(card_info, collection_directory, journal,
+                            worker_index=worker_index,
+                            worker_count=worker_count,
+                            compression=compression)
 
 
 if __name__ == '__main__':
@@ -85,6 +186,31 @@ if __name__ == '__main__':
                         required=True,
                         help='configuration file path for credentials',
                         )
+    parser.add_argument('--resume', '-r',
+                        dest='resume',
+                        action='store_true',
+                        help='skip cards already recorded in the export '
+                             'journal of a previous run',
+                        )
+    parser.add_argument('--worker_index',
+                        dest='worker_index',
+                        default=0,
+                        type=int,
+                        help='index of this process when the export is '
+                             'split across several processes',
+                        )
+    parser.add_argument('--worker_count',
+                        dest='worker_count',
+                        default=1,
+                        type=int,
+                        help='total number of processes sharing the export',
+                        )
+    parser.add_argument('--compress',
+                        dest='compression',
+                        default=None,
+                        choices=['gzip', 'zstd'],
+                        help='compress saved sql files',
+                        )
 
     args = parser.parse_args()
 
@@ -107,6 +233,10 @@ if __name__ == '__main__':
         create_dir(destination_directory)
         try:
             download_cards(destination_directory=destination_directory,
+                           resume=args.resume,
+                           worker_index=args.worker_index,
+                           worker_count=args.worker_count,
+                           compression=args.compression,
                            **credential_info)
         except AuthorizationFailedException as afex:
             logger.error("Authentication failed for {} -> {}".format(
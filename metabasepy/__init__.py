@@ -1,11 +1,25 @@
 from metabasepy.client import (
     Client,
     AuthorizationFailedException,
-    RequestException
+    RequestException,
+    SingleFlight
+)
+
+from metabasepy.deadline import (
+    Deadline,
+    DeadlineExceeded
 )
 
 from metabasepy.table_parser import (
     MetabaseTableParser,
     MetabaseTable,
+    SpillingRows,
     MetabaseResultInvalidException
 )
+
+from metabasepy.models import (
+    Card,
+    Collection,
+    Database,
+    User
+)
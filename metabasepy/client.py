@@ -1,14 +1,124 @@
+import codecs
+import csv
+import hashlib
+import os
 import re
+import secrets
+import string
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import urllib3
 import json
 
+from metabasepy.compression import (
+    CHUNK_SIZE,
+    compressed_path,
+    open_output,
+    validate_compression
+)
+from metabasepy.concurrency import RateLimiter
+from metabasepy.deadline import (
+    Deadline,
+    DeadlineExceeded,
+    check_deadline,
+    current_deadline,
+    current_timeout,
+    deadline_scope,
+    request_timeout,
+    timeout_scope
+)
+from metabasepy.models import Card, Collection, Database, User
+from metabasepy.table_parser import MetabaseTableParser
+
 try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode
 
 
+# (connect, read) timeout in seconds. The read timeout bounds the silence
+# between two reads, not the whole response: metabase keeps long running
+# queries alive by sending a newline every second, so it only fires on a
+# stuck connection
+DEFAULT_TIMEOUT = (10, 300)
+
+PASSWORD_SYMBOLS = "!#$%&()*+,-./:;<=>?@[]^_{|}~"
+
+# seconds between deadline checks of callers waiting on a shared request
+SINGLE_FLIGHT_POLL = 0.1
+
+
+def deadline_error(ex):
+    """ DeadlineExceeded for an error caused by the active deadline, or
+    None when the deadline is not the reason. """
+    deadline = current_deadline()
+    if deadline is not None and deadline.expired:
+        return DeadlineExceeded("deadline exceeded: {}".format(ex))
+    return None
+
+
+def read_body(response):
+    """ Read a streamed response body as it arrives, checking the active
+    deadline between reads, and keep it as the response content. """
+    chunks = []
+    try:
+        if hasattr(response.raw, 'read1'):
+            # urllib3 2 returns whatever has arrived, so a slow trickle of
+            # bytes (eg. keepalive newlines) can't hold up a deadline check
+            while True:
+                check_deadline()
+                chunk = response.raw.read1(CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        else:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                check_deadline()
+                chunks.append(chunk)
+    except DeadlineExceeded:
+        response.close()
+        raise
+    except (urllib3.exceptions.HTTPError, requests.RequestException) as ex:
+        response.close()
+        error = deadline_error(ex)
+        if error is not None:
+            raise error
+        if isinstance(ex, requests.RequestException):
+            raise
+        raise requests.exceptions.ConnectionError(ex)
+    response._content = b''.join(chunks)
+    response._content_consumed = True
+    response.raw.release_conn()
+    return response
+
+
+def send_request(session, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """ Send a request with the timeout cut down to the active deadline.
+
+    Raises DeadlineExceeded instead of sending when the deadline has passed
+    or was cancelled, and when the request timed out because of it. With
+    an active deadline the body is streamed and the deadline checked while
+    it is read, so a response that keeps trickling in is cut off too. """
+    bounded = current_deadline() is not None and not kwargs.get('stream')
+    if bounded:
+        kwargs['stream'] = True
+    try:
+        response = getattr(session, method)(
+            timeout=request_timeout(timeout), **kwargs)
+    except requests.exceptions.Timeout as ex:
+        error = deadline_error(ex)
+        if error is not None:
+            raise error
+        raise
+    if bounded:
+        read_body(response)
+    return response
+
+
 def get_file_export_path(file_name):
     from os import getcwd
     from os.path import join
@@ -30,6 +140,83 @@ def parse_filename_from_response_header(response):
     return selected_filename.strip('"').strip("'")
 
 
+def response_charset(response, default='utf-8'):
+    """ Charset named in the Content-Type header, or default. Unlike
+    response.encoding it does not fall back to ISO-8859-1 for text types,
+    Metabase's csv export is utf-8 without saying so. """
+    content_type = response.headers.get('Content-Type') or ''
+    match = re.search(r'charset=["\']?([\w.:-]+)', content_type, re.I)
+    return match.group(1) if match else default
+
+
+def iter_text_lines(chunks, encoding='utf-8'):
+    """ Decode byte chunks and yield the text lines they hold, each with
+    its newline, as the csv module expects. """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def random_password(length=24):
+    """ Random password passing Metabase's strictest complexity setting: at
+    least two lower and upper case letters, a digit and a symbol. """
+    alphabet = string.ascii_letters + string.digits + PASSWORD_SYMBOLS
+    while True:
+        password = ''.join(secrets.choice(alphabet) for _ in range(length))
+        if sum(c.islower() for c in password) >= 2 and \
+                sum(c.isupper() for c in password) >= 2 and \
+                any(c.isdigit() for c in password) and \
+                any(c in PASSWORD_SYMBOLS for c in password):
+            return password
+
+
+def execute_concurrently(func, arguments, max_workers=8, limiter=None,
+                         rate_limiter=None):
+    """ Call func(**kwargs) for each kwargs in arguments on a thread pool.
+
+    Returns one report per call in input order with either the result or
+    the exception raised by that call. An AdaptiveConcurrencyLimiter can
+    further restrict how many of the max_workers calls run at once, and a
+    RateLimiter how many start per second; calls wait for the rate limiter
+    before taking a concurrency slot, so that wait is not counted as their
+    latency.
+
+    The caller's deadline and timeout override apply to every call, calls
+    still queued when the deadline passes fail with DeadlineExceeded
+    without being made. """
+    deadline = current_deadline()
+    timeout = current_timeout()
+
+    def call(kwargs):
+        try:
+            with deadline_scope(deadline), timeout_scope(timeout):
+                check_deadline()
+                return {"ok": True, "result": func(**kwargs), "error": None}
+        except Exception as ex:
+            return {"ok": False, "result": None, "error": ex}
+
+    def run(kwargs):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        if limiter is None:
+            return call(kwargs)
+        limiter.acquire()
+        started_at = time.time()
+        report = call(kwargs)
+        limiter.release(latency=time.time() - started_at, ok=report["ok"])
+        return report
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, arguments))
+
+
 class AuthorizationFailedException(Exception):
     pass
 
@@ -39,12 +226,89 @@ class RequestException(Exception):
         self.message = message
 
 
+class SingleFlight(object):
+    """ Shares one in-flight call between concurrent callers asking for the
+    same key. Callers arriving while the call runs wait for it and receive
+    the same result (or exception), or DeadlineExceeded when their own
+    deadline passes first. When the shared call fails because of the
+    leader's deadline, the waiting callers try again on their own. """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is not None:
+                    self.coalesced += 1
+                    leader = False
+                else:
+                    call = SingleFlight._Call()
+                    self._calls[key] = call
+                    self.executed += 1
+                    leader = True
+
+            if not leader:
+                SingleFlight._wait(call)
+                if isinstance(call.error, DeadlineExceeded):
+                    # the leader ran out of time, not necessarily this
+                    # caller: retry, becoming the leader if none is left
+                    check_deadline()
+                    continue
+            else:
+                try:
+                    call.result = fn()
+                except Exception as ex:
+                    call.error = ex
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call.done.set()
+
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    @staticmethod
+    def _wait(call):
+        """ Wait for the leader's call within this caller's deadline. """
+        deadline = current_deadline()
+        if deadline is None:
+            call.done.wait()
+        while not call.done.is_set():
+            # wake up now and then to notice a cancelled deadline
+            deadline.check()
+            remaining = deadline.remaining()
+            call.done.wait(SINGLE_FLIGHT_POLL if remaining is None
+                           else min(remaining, SINGLE_FLIGHT_POLL))
+
+    @property
+    def stats(self):
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced
+        }
+
+
 class Resource(object):
     def __init__(self, **kwargs):
         self.base_url = kwargs.get('base_url')
         self.token = kwargs.get('token')
         self.verify = kwargs.get('verify', True)
         self.proxies = kwargs.get('proxies')
+        self.single_flight = kwargs.get('single_flight')
+        self.session = kwargs.get('session') or requests
+        self.timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
 
     def prepare_headers(self):
         return {
@@ -52,6 +316,36 @@ class Resource(object):
             'Content-Type': 'application/json'
         }
 
+    def send_request(self, method, **kwargs):
+        return send_request(self.session, method, timeout=self.timeout,
+                            **kwargs)
+
+    # metabasepy.models class the responses are turned into on request
+    model = None
+
+    def to_model(self, data, as_model):
+        if not as_model or self.model is None:
+            return data
+        return self.model.build(data)
+
+    def get_json(self, url):
+        """ GET url and return the decoded json body. Identical concurrent
+        calls share a single request when single_flight is set. """
+        def fetch():
+            resp = self.send_request(
+                method="get",
+                url=url,
+                headers=self.prepare_headers(),
+                verify=self.verify,
+                proxies=self.proxies
+            )
+            Resource.validate_response(response=resp)
+            return resp.json()
+
+        if self.single_flight is None:
+            return fetch()
+        return self.single_flight.do(key=(url, self.token), fn=fetch)
+
     @staticmethod
     def validate_response(response):
         request_method = response.request.method
@@ -63,7 +357,7 @@ class Resource(object):
             if status_code not in [200, 201, 202]:
                 raise RequestException(message=response.content)
         elif request_method == "PUT":
-            if status_code != 204:
+            if status_code not in [200, 202, 204]:
                 raise RequestException(message=response.content)
         elif request_method == "DELETE":
             if status_code != 204:
@@ -95,6 +389,8 @@ class ApiCommand(object):
         self.token = kwargs.get('token')
         self.verify = kwargs.get('verify', True)
         self.proxies = kwargs.get('proxies')
+        self.session = kwargs.get('session') or requests
+        self.timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
 
     def prepare_headers(self):
         return {
@@ -102,6 +398,10 @@ class ApiCommand(object):
             'Content-Type': 'application/json'
         }
 
+    def send_request(self, method, **kwargs):
+        return send_request(self.session, method, timeout=self.timeout,
+                            **kwargs)
+
     def post(self, **kwargs):
         raise NotImplementedError()
 
@@ -118,30 +418,26 @@ class ApiCommand(object):
 
 class DatabaseResource(Resource):
 
+    model = Database
+
     @property
     def endpoint(self):
         return "{}/api/database".format(self.base_url)
 
-    def get(self, database_id=None):
+    def get(self, database_id=None, as_model=False):
         url = self.endpoint
         if database_id:
             url = "{}/{}".format(url, database_id)
-        resp = requests.get(
-            url=self.endpoint,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.to_model(self.get_json(url=url), as_model)
 
-    def get_by_name(self, name):
-        all_dbs = self.get()
+    def get_by_name(self, name, as_model=False):
+        all_dbs = self.get(as_model=as_model)
         return [db for db in all_dbs if db['name'] == name]
 
     def delete(self, database_id):
         url = "{}/{}".format(self.endpoint, database_id)
-        resp = requests.delete(
+        resp = self.send_request(
+            method="delete",
             url=url,
             headers=self.prepare_headers(),
             verify=self.verify,
@@ -164,7 +460,8 @@ class DatabaseResource(Resource):
                 "tunnel_port": tunnel_port
             }
         }
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=self.endpoint,
             json=request_data,
             headers=self.prepare_headers(),
@@ -178,37 +475,25 @@ class DatabaseResource(Resource):
 
 class CardResource(Resource):
 
+    model = Card
+
     @property
     def endpoint(self):
         return "{}/api/card".format(self.base_url)
 
-    def get(self, card_id=None):
+    def get(self, card_id=None, as_model=False):
         url = self.endpoint
         if card_id:
             url = "{}/{}".format(self.endpoint, card_id)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.to_model(self.get_json(url=url), as_model)
 
-    def get_by_collection(self, collection_slug):
+    def get_by_collection(self, collection_slug, as_model=False):
         """
         :param collection_slug:
         :return:
         """
         url = "{}?f=all&collection={}".format(self.endpoint, collection_slug)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.to_model(self.get_json(url=url), as_model)
 
     def post(self, database_id, name, query, **kwargs):
         request_data = {
@@ -227,7 +512,8 @@ class CardResource(Resource):
             "description": kwargs.get('description', None),
             "collection_id": kwargs.get('collection_id', None)
         }
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=self.endpoint,
             json=request_data,
             headers=self.prepare_headers(),
@@ -240,7 +526,8 @@ class CardResource(Resource):
 
     def put(self, card_id, **kwargs):
         url = "{}/{}".format(self.endpoint, card_id)
-        resp = requests.put(
+        resp = self.send_request(
+            method="put",
             url=url,
             json=kwargs,
             headers=self.prepare_headers(),
@@ -250,7 +537,8 @@ class CardResource(Resource):
 
     def delete(self, card_id):
         url = "{}/{}".format(self.endpoint, card_id)
-        resp = requests.delete(
+        resp = self.send_request(
+            method="delete",
             url=url,
             headers=self.prepare_headers(),
             verify=self.verify,
@@ -258,11 +546,85 @@ class CardResource(Resource):
         )
         Resource.validate_response(response=resp)
 
+    @staticmethod
+    def _card_reports(card_ids, reports):
+        for card_id, report in zip(card_ids, reports):
+            report["card_id"] = card_id
+        return reports
+
+    def bulk_post(self, cards, max_workers=8, limiter=None):
+        """ Create many cards concurrently.
+
+        :param cards: list of dicts with CardResource.post arguments
+        :return: list of reports, "card_id" is None for failed cards
+        """
+        reports = execute_concurrently(self.post, list(cards),
+                                       max_workers=max_workers,
+                                       limiter=limiter)
+        return CardResource._card_reports(
+            [report["result"] for report in reports], reports)
+
+    def bulk_put(self, updates, max_workers=8, limiter=None):
+        """
+        :param updates: dict of card_id to the fields to update
+        :return: list of per card reports
+        """
+        card_ids = list(updates)
+        arguments = [dict(updates[card_id], card_id=card_id)
+                     for card_id in card_ids]
+        reports = execute_concurrently(self.put, arguments,
+                                       max_workers=max_workers,
+                                       limiter=limiter)
+        return CardResource._card_reports(card_ids, reports)
+
+    def bulk_delete(self, card_ids, max_workers=8, limiter=None):
+        card_ids = list(card_ids)
+        reports = execute_concurrently(
+            self.delete, [{"card_id": card_id} for card_id in card_ids],
+            max_workers=max_workers, limiter=limiter)
+        return CardResource._card_reports(card_ids, reports)
+
+    def bulk_archive(self, card_ids, max_workers=8, limiter=None):
+        return self.bulk_put({card_id: {"archived": True}
+                              for card_id in card_ids},
+                             max_workers=max_workers,
+                             limiter=limiter)
+
+    def bulk_move(self, card_ids, collection_id, max_workers=8,
+                  limiter=None):
+        """ Move cards into a collection with a single call to
+        /api/card/collections, falling back to one PUT per card when the
+        server rejects the bulk request. """
+        card_ids = list(card_ids)
+        url = "{}/collections".format(self.endpoint)
+        try:
+            resp = self.send_request(
+                method="post",
+                url=url,
+                json={"card_ids": card_ids, "collection_id": collection_id},
+                headers=self.prepare_headers(),
+                verify=self.verify,
+                proxies=self.proxies
+            )
+            Resource.validate_response(response=resp)
+        except RequestException:
+            return self.bulk_put({card_id: {"collection_id": collection_id}
+                                  for card_id in card_ids},
+                                 max_workers=max_workers,
+                                 limiter=limiter)
+        return [{"card_id": card_id, "ok": True, "result": None,
+                 "error": None} for card_id in card_ids]
+
     def query(self, card_id, parameters=None):
-        # TODO : add parameters usage
+        """
+        :param parameters: list of metabase parameter objects, eg.
+            [{"type": "category", "target": [...], "value": "x"}]
+        """
         url = "{}/{}/query".format(self.endpoint, card_id)
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=url,
+            json={"parameters": parameters} if parameters else None,
             headers=self.prepare_headers(),
             verify=self.verify,
             proxies=self.proxies
@@ -278,7 +640,8 @@ class CardResource(Resource):
         if parameters:
             parameters = urlencode({k: json.dumps(v)
                                     for k, v in parameters.items()})
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=url,
             headers=self.prepare_headers(),
             params=parameters, verify=self.verify,
@@ -290,24 +653,19 @@ class CardResource(Resource):
 
 class CollectionResource(Resource):
 
+    model = Collection
+
     @property
     def endpoint(self):
         return "{}/api/collection".format(self.base_url)
 
-    def get(self, collection_id=None, archived=False):
+    def get(self, collection_id=None, archived=False, as_model=False):
         url = self.endpoint
         if collection_id:
             url = "{}/{}".format(self.endpoint, collection_id)
         elif archived:
             url = "{}?archived=true"
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.to_model(self.get_json(url=url), as_model)
 
     def post(self, name, color="#000000", **kwargs):
         request_data = {
@@ -315,7 +673,8 @@ class CollectionResource(Resource):
             "description": kwargs.get('description'),
             "color": color
         }
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=self.endpoint,
             json=request_data,
             headers=self.prepare_headers(),
@@ -327,7 +686,8 @@ class CollectionResource(Resource):
 
     def delete(self, collection_id):
         url = "{}/{}".format(self.endpoint, collection_id)
-        resp = requests.delete(
+        resp = self.send_request(
+            method="delete",
             url=url,
             headers=self.prepare_headers(),
             verify=self.verify,
@@ -338,34 +698,24 @@ class CollectionResource(Resource):
 
 class UserResource(Resource):
 
+    model = User
+
     @property
     def endpoint(self):
         return "{}/api/user".format(self.base_url)
 
-    def get(self, user_id=None):
+    def get(self, user_id=None, as_model=False, include_deactivated=False):
         url = self.endpoint
         if user_id:
             url = "{}/{}".format(self.endpoint, user_id)
+        elif include_deactivated:
+            url = "{}?include_deactivated=true".format(self.endpoint)
 
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.to_model(self.get_json(url=url), as_model)
 
-    def current(self):
+    def current(self, as_model=False):
         url = "{}/current".format(self.endpoint)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.to_model(self.get_json(url=url), as_model)
 
     def post(self, first_name, last_name, email, password):
         request_data = {
@@ -374,7 +724,8 @@ class UserResource(Resource):
             "email": email,
             "password": password
         }
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=self.endpoint,
             json=request_data,
             headers=self.prepare_headers(),
@@ -385,9 +736,92 @@ class UserResource(Resource):
         json_response = resp.json()
         return json_response['id']
 
+    @staticmethod
+    def read_users_csv(path):
+        """ Users from a csv file with first_name, last_name, email and
+        optionally password columns. """
+        with open(path, 'r', newline='') as f:
+            return list(csv.DictReader(f))
+
+    def bulk_provision(self, users, invite=False, max_workers=4, rate=None,
+                       limiter=None):
+        """ Create the users missing from the server, Metabase emails each
+        created user an invitation itself.
+
+        Users are matched to the existing ones, deactivated users included,
+        by email, case insensitive, so running it again after a failure only
+        creates what is left. Resent invites are not retried by a new run: a
+        user whose resend failed is reported "created" with "invited" False
+        and the error, and is reported "exists" afterwards.
+
+        :param users: csv file path or iterable of dicts with first_name,
+            last_name, email and optional password keys; users without a
+            password get a random one
+        :param invite: also resend the invitation through send_invite,
+            on top of the one sent on creation
+        :param rate: at most this many users are created per second
+        :return: list of reports in input order with "email", "status"
+            ("exists", "created", "duplicate" or "failed"), "user_id",
+            "invited" (True once an invitation was resent) and "error" keys
+        """
+        if isinstance(users, str):
+            users = UserResource.read_users_csv(users)
+
+        existing = self.get(include_deactivated=True)
+        if isinstance(existing, dict):
+            existing = existing.get('data', [])
+        email_index = {user['email'].lower(): user['id']
+                       for user in existing if user.get('email')}
+
+        reports = []
+        missing = []
+        for user in users:
+            email = user['email'].strip()
+            report = {"email": email, "status": None, "user_id": None,
+                      "invited": False, "error": None}
+            reports.append(report)
+            key = email.lower()
+            if key not in email_index:
+                # marks the email as taken by this batch
+                email_index[key] = None
+                missing.append((report, user))
+            elif email_index[key] is None:
+                report["status"] = "duplicate"
+            else:
+                report["status"] = "exists"
+                report["user_id"] = email_index[key]
+
+        rate_limiter = RateLimiter(rate) if rate else None
+
+        def provision(report, user):
+            user_id = self.post(
+                first_name=user.get('first_name'),
+                last_name=user.get('last_name'),
+                email=report["email"],
+                password=user.get('password') or random_password())
+            report["status"] = "created"
+            report["user_id"] = user_id
+            if invite:
+                self.send_invite(user_id=user_id)
+                report["invited"] = True
+
+        results = execute_concurrently(
+            provision,
+            [{"report": report, "user": user} for report, user in missing],
+            max_workers=max_workers, limiter=limiter,
+            rate_limiter=rate_limiter)
+        for (report, _), result in zip(missing, results):
+            if not result["ok"]:
+                # a created user whose invite failed keeps its status
+                report["error"] = result["error"]
+                if report["status"] is None:
+                    report["status"] = "failed"
+        return reports
+
     def delete(self, user_id):
         url = "{}/{}".format(self.endpoint, user_id)
-        resp = requests.delete(
+        resp = self.send_request(
+            method="delete",
             url=url,
             headers=self.prepare_headers(),
             verify=self.verify,
@@ -397,7 +831,8 @@ class UserResource(Resource):
 
     def send_invite(self, user_id):
         url = "{}/{}/send_invite".format(self.endpoint, user_id)
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=url,
             headers=self.prepare_headers(),
             verify=self.verify,
@@ -412,7 +847,8 @@ class UserResource(Resource):
             "password": password,
             "old_password": old_password
         }
-        resp = requests.put(
+        resp = self.send_request(
+            method="put",
             url=url,
             json=request_data,
             headers=self.prepare_headers(),
@@ -431,43 +867,79 @@ class UtilityResource(Resource):
 
     def logs(self):
         url = "{}/logs".format(self.endpoint)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.get_json(url=url)
+
+    @staticmethod
+    def _log_entry_key(entry):
+        content = json.dumps(entry, sort_keys=True).encode('utf-8')
+        return entry.get('timestamp'), hashlib.sha1(content).hexdigest()
+
+    def tail(self, interval=5.0, levels=None, namespaces=None, window=10000,
+             include_existing=True, max_polls=None):
+        """ Poll the server logs and yield only entries not seen before.
+
+        :param interval: seconds to wait between polls
+        :param levels: only yield entries with one of these levels
+        :param namespaces: only yield entries whose fqns starts with one of
+            these prefixes
+        :param window: how many seen entries are remembered to drop repeats
+        :param include_existing: yield the entries already in the buffer on
+            the first poll
+        :param max_polls: stop after this many polls, poll forever if None
+        """
+        if levels:
+            levels = {level.upper() for level in levels}
+        namespaces = tuple(namespaces) if namespaces else None
+        seen = OrderedDict()
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            if polls:
+                time.sleep(interval)
+            first_poll = polls == 0
+            polls += 1
+
+            # the server lists the newest entries first, walk them oldest
+            # first so the newest keys are the last ones evicted
+            entries = sorted(self.logs(),
+                             key=lambda e: e.get('timestamp') or '')
+            new_entries = []
+            for entry in entries:
+                # filter first, only matching entries are hashed and kept
+                if levels and \
+                        (entry.get('level') or '').upper() not in levels:
+                    continue
+                if namespaces and \
+                        not (entry.get('fqns') or '').startswith(namespaces):
+                    continue
+                key = UtilityResource._log_entry_key(entry)
+                if key in seen:
+                    seen.move_to_end(key)
+                    continue
+                seen[key] = True
+                if len(seen) > window:
+                    seen.popitem(last=False)
+                if first_poll and not include_existing:
+                    continue
+                new_entries.append(entry)
+
+            for entry in new_entries:
+                yield entry
 
     def random_token(self):
         url = "{}/random_token".format(self.endpoint)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.get_json(url=url)
 
     def stats(self):
         url = "{}/stats".format(self.endpoint)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.get_json(url=url)
 
     def password_check(self, password):
         url = "{}/password_check".format(self.endpoint)
         request_data = {
             "password": password,
         }
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=url,
             json=request_data,
             headers=self.prepare_headers(),
@@ -479,14 +951,7 @@ class UtilityResource(Resource):
 
     def connection_pool_info(self):
         url = "{}/diagnostic_info/connection_pool_info".format(self.endpoint)
-        resp = requests.get(
-            url=url,
-            headers=self.prepare_headers(),
-            verify=self.verify,
-            proxies=self.proxies
-        )
-        Resource.validate_response(response=resp)
-        return resp.json()
+        return self.get_json(url=url)
 
 
 class DatasetCommand(ApiCommand):
@@ -512,7 +977,8 @@ class DatasetCommand(ApiCommand):
             "database": database_id,
             "parameters": []
         }
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=self.endpoint,
             json=request_data,
             headers=self.prepare_headers(),
@@ -523,11 +989,9 @@ class DatasetCommand(ApiCommand):
         json_response = resp.json()
         return json_response
 
-    def export(self, database_id, query, export_format, full_path=None):
-        """ redirects dataset query to available export endpoint,
-         saves it in folder given with to_file_path parameter
-         or current working directory by default."""
-
+    def request_export(self, database_id, query, export_format):
+        """ Post the query to the export endpoint and return the streamed
+        response, its body has not been read yet. """
         query_request_data = {
             "type": "native",
             "native": {
@@ -550,14 +1014,28 @@ class DatasetCommand(ApiCommand):
             command_endpoint=self.endpoint,
             export_param=export_format
         )
-        resp = requests.post(
+        return self.send_request(
+            method="post",
             url=command_url,
             data=request_data,
             headers=headers,
             verify=self.verify,
-            proxies=self.proxies
+            proxies=self.proxies,
+            stream=True
         )
 
+    def export(self, database_id, query, export_format, full_path=None,
+               compression=None):
+        """ redirects dataset query to available export endpoint,
+         saves it in folder given with to_file_path parameter
+         or current working directory by default.
+
+         The response is streamed to the file as it arrives, compressed
+         with gzip or zstd when compression is given."""
+        validate_compression(compression)
+        resp = self.request_export(database_id=database_id, query=query,
+                                   export_format=export_format)
+
         if not full_path:
             file_name = parse_filename_from_response_header(response=resp) \
                         or "metabase_dataset_export.{extension}".format(
@@ -566,15 +1044,89 @@ class DatasetCommand(ApiCommand):
         else:
             export_file_path = full_path
 
-        file_access_mode = "w"
-        if type(resp.content) == bytes:
-            file_access_mode = "wb"
+        export_file_path = compressed_path(export_file_path, compression)
 
-        with open(file=export_file_path, mode=file_access_mode) as f:
-            f.write(resp.content)
+        try:
+            with open_output(export_file_path, compression) as f:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    check_deadline()
+                    f.write(chunk)
+        except DeadlineExceeded:
+            resp.close()
+            os.remove(export_file_path)
+            raise
 
         return export_file_path
 
+    def export_iter(self, database_id, query, as_dict=False, batch_size=None,
+                    converters=None):
+        """ Run the query through the csv export and yield rows while they
+        are read from the response stream, nothing is written to disk.
+
+        :param as_dict: yield dicts keyed by column name instead of tuples
+        :param batch_size: yield lists of this many rows instead of rows
+        :param converters: dict of column name to callable applied to the
+            column's values, empty values become None
+        """
+        resp = self.request_export(database_id=database_id, query=query,
+                                   export_format='csv')
+        try:
+            ApiCommand.validate_response(response=resp)
+            # iter_content undoes any content encoding, and also serves a
+            # body a recording session has already read
+            lines = iter_text_lines(
+                resp.iter_content(chunk_size=CHUNK_SIZE),
+                encoding=response_charset(resp))
+            reader = csv.reader(lines)
+            header = next(reader, None)
+            if header is None:
+                return
+            converters = converters or {}
+            column_converters = [converters.get(name) for name in header]
+            if not any(column_converters):
+                column_converters = None
+
+            batch = []
+            for values in reader:
+                check_deadline()
+                if column_converters:
+                    values = [value if converter is None else
+                              (None if value == '' else converter(value))
+                              for converter, value in
+                              zip(column_converters, values)]
+                row = dict(zip(header, values)) if as_dict else tuple(values)
+                if not batch_size:
+                    yield row
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            resp.close()
+
+    def post_many(self, queries, max_workers=8, limiter=None):
+        """ Run many native queries concurrently and merge their results.
+
+        :param queries: list of (database_id, query) pairs, all returning
+            the same columns
+        :return: MetabaseTable with the rows in input order, its sources
+            holds the index of the query each row came from
+        """
+        queries = list(queries)
+        reports = execute_concurrently(
+            self.post,
+            [{"database_id": database_id, "query": query}
+             for database_id, query in queries],
+            max_workers=max_workers, limiter=limiter)
+        for report in reports:
+            if not report["ok"]:
+                raise report["error"]
+        return MetabaseTableParser.merge_tables(
+            [report["result"] for report in reports], queries=queries)
+
     def duration(self, database_id, query):
         """ Get historical query execution duration. """
         request_data = {
@@ -587,7 +1139,8 @@ class DatasetCommand(ApiCommand):
             "parameters": []
         }
         command_url = "{}/duration".format(self.endpoint)
-        resp = requests.post(
+        resp = self.send_request(
+            method="post",
             url=command_url,
             json=request_data,
             headers=self.prepare_headers(),
@@ -607,6 +1160,11 @@ class Client(object):
         self.token = kwargs.get('token')
         self.verify = kwargs.get('verify', True)
         self.proxies = kwargs.get('proxies')
+        self.session = kwargs.get('session') or requests
+        self.timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
+        self.single_flight = None
+        if kwargs.get('coalesce_requests', False):
+            self.single_flight = SingleFlight()
 
     def __get_auth_url(self):
         return "{}/api/session".format(self.base_url)
@@ -619,7 +1177,10 @@ class Client(object):
         request_headers = {
             'Content-Type': 'application/json'
         }
-        resp = requests.post(
+        resp = send_request(
+            self.session,
+            method="post",
+            timeout=self.timeout,
             url=self.__get_auth_url(),
             json=request_data,
             headers=request_headers,
@@ -633,38 +1194,58 @@ class Client(object):
 
         self.token = json_response['id']
 
+    @staticmethod
+    def deadline(seconds=None):
+        """ Deadline for every call made inside the with block on this
+        thread, including the concurrent work those calls start::
+
+            with cli.deadline(30) as deadline:
+                cli.cards.bulk_archive(card_ids)
+
+        deadline.cancel() stops work that has not started yet. """
+        return deadline_scope(Deadline(seconds))
+
+    @staticmethod
+    def timeout_override(timeout):
+        """ Use another timeout for the calls made inside the with block on
+        this thread, including the concurrent work those calls start::
+
+            with cli.timeout_override((5, 30)):
+                card = cli.cards.get(card_id=1)
+        """
+        return timeout_scope(timeout)
+
+    def resource_kwargs(self):
+        return {
+            "base_url": self.base_url,
+            "token": self.token,
+            "verify": self.verify,
+            "proxies": self.proxies,
+            "session": self.session,
+            "timeout": self.timeout,
+            "single_flight": self.single_flight
+        }
+
     @property
     def databases(self):
-        return DatabaseResource(base_url=self.base_url,
-                                token=self.token,
-                                verify=self.verify)
+        return DatabaseResource(**self.resource_kwargs())
 
     @property
     def cards(self):
-        return CardResource(base_url=self.base_url,
-                            token=self.token,
-                            verify=self.verify)
+        return CardResource(**self.resource_kwargs())
 
     @property
     def collections(self):
-        return CollectionResource(base_url=self.base_url,
-                                  token=self.token,
-                                  verify=self.verify)
+        return CollectionResource(**self.resource_kwargs())
 
     @property
     def users(self):
-        return UserResource(base_url=self.base_url,
-                            token=self.token,
-                            verify=self.verify)
+        return UserResource(**self.resource_kwargs())
 
     @property
     def utils(self):
-        return UtilityResource(base_url=self.base_url,
-                               token=self.token,
-                               verify=self.verify)
+        return UtilityResource(**self.resource_kwargs())
 
     @property
     def dataset(self):
-        return DatasetCommand(base_url=self.base_url,
-                              token=self.token,
-                              verify=self.verify)
+        return DatasetCommand(**self.resource_kwargs())
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+""" Compression helpers for downloads and exported files. """
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FILE_EXTENSIONS = {
+    'gzip': 'gz',
+    'zstd': 'zst',
+}
+
+# bytes read from the socket per chunk when streaming a download
+CHUNK_SIZE = 64 * 1024
+
+
+def validate_compression(compression):
+    if compression is None:
+        return
+    if compression not in FILE_EXTENSIONS:
+        raise ValueError('{} compression not supported!'.format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+
+
+def compressed_path(path, compression):
+    """ path with the extension of the compression appended. """
+    if compression is None:
+        return path
+    extension = FILE_EXTENSIONS[compression]
+    if path.endswith("." + extension):
+        return path
+    return "{}.{}".format(path, extension)
+
+
+class _ZstdFile(object):
+    """ Binary file object writing zstd frames through a stream writer. """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.writer = zstandard.ZstdCompressor().stream_writer(
+            fileobj, closefd=False)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def flush(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.fileobj.flush()
+
+    def close(self):
+        self.writer.close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_output(path, compression=None):
+    """ Open path for binary writing through the given compression. """
+    validate_compression(compression)
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'zstd':
+        return _ZstdFile(open(path, 'wb'))
+    return open(path, 'wb')
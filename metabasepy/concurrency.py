@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+""" Admission control for the concurrent batch APIs. """
+import threading
+import time
+from contextlib import contextmanager
+
+
+def pool_saturation(connection_pool_info):
+    """ Highest busy / max size ratio of the connection pools reported by
+    UtilityResource.connection_pool_info, or None when it can't be told. """
+    pools = (connection_pool_info or {}).get('connection-pools') or {}
+    saturation = None
+    for pool in pools.values():
+        size = pool.get('maxPoolSize') or pool.get('numConnections')
+        busy = pool.get('numBusyConnections')
+        if not size or busy is None:
+            continue
+        ratio = float(busy) / size
+        if saturation is None or ratio > saturation:
+            saturation = ratio
+    return saturation
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """ AIMD limit on the number of requests in flight.
+
+    Each fast, successful request raises the limit by 1 / limit (about one
+    more slot per round trip). An error, a request slower than
+    latency_tolerance times its usual latency, or a server connection pool
+    busier than max_pool_saturation multiplies the limit by backoff.
+
+    The usual latency is a moving average of successful requests, kept per
+    key so that requests of different cost (eg. different queries) are
+    compared with their own kind. The limit is cut at most once per round
+    trip: requests which started before the last cut do not cut it again.
+
+    When utils (a UtilityResource) is given, its connection_pool_info is
+    polled at most every poll_interval seconds by a finishing request. """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, backoff=0.5,
+                 latency_tolerance=2.0, utils=None, poll_interval=5.0,
+                 max_pool_saturation=0.9, smoothing=0.2):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.utils = utils
+        self.poll_interval = poll_interval
+        self.max_pool_saturation = max_pool_saturation
+        self.in_flight = 0
+        self.baselines = {}
+        self.saturation = None
+        self._last_decrease = 0
+        self._last_poll = 0
+        self._polling = False
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok=True, key=None):
+        """
+        :param latency: seconds the request took
+        :param key: kind of request, its latency is only compared with
+            earlier requests of the same key
+        """
+        poll = False
+        with self._condition:
+            now = time.time()
+            self.in_flight -= 1
+            baseline = self.baselines.get(key)
+            overloaded = not ok or \
+                (baseline is not None and
+                 latency > baseline * self.latency_tolerance) or \
+                (self.saturation is not None and
+                 self.saturation > self.max_pool_saturation)
+            if ok:
+                self.baselines[key] = latency if baseline is None else \
+                    self.smoothing * latency + \
+                    (1 - self.smoothing) * baseline
+            if overloaded:
+                if now - latency >= self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if self.utils is not None and not self._polling and \
+                    now - self._last_poll >= self.poll_interval:
+                self._polling = poll = True
+            self._condition.notify_all()
+        if poll:
+            self.poll()
+
+    def poll(self):
+        """ Refresh the server connection pool saturation. """
+        try:
+            saturation = pool_saturation(self.utils.connection_pool_info())
+        except Exception:
+            saturation = None
+        with self._condition:
+            self.saturation = saturation
+            self._last_poll = time.time()
+            self._polling = False
+
+    @contextmanager
+    def slot(self, key=None):
+        """ Hold one in-flight slot for the duration of the block. """
+        self.acquire()
+        started_at = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.release(latency=time.time() - started_at, ok=ok, key=key)
+
+
+class RateLimiter(object):
+    """ Lets at most rate calls per second through, with bursts of up to
+    burst calls (token bucket). """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Block until the next call may be made. """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
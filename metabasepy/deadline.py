@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+""" Deadlines and cooperative cancellation for client calls. """
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message=None):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+class Deadline(object):
+    """ Point in time after which no more requests should be started.
+
+    A deadline may also be cancelled before it expires, work checking it
+    stops the same way. """
+
+    def __init__(self, seconds=None):
+        self.expires_at = time.time() + seconds if seconds is not None \
+            else None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """ Seconds left, None when there is no time limit. """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.time())
+
+    @property
+    def expired(self):
+        return self.cancelled or self.remaining() == 0.0
+
+    def check(self):
+        if self.cancelled:
+            raise DeadlineExceeded("cancelled")
+        if self.remaining() == 0.0:
+            raise DeadlineExceeded("deadline exceeded")
+
+
+def current_deadline():
+    """ Deadline active on this thread, if any. """
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """ Make deadline the active one on this thread inside the block.
+
+    Threads started inside the block do not inherit it, pass it on with
+    another deadline_scope in the thread. """
+    previous = current_deadline()
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+
+def current_timeout():
+    """ Timeout override active on this thread, if any. """
+    return getattr(_local, 'timeout', None)
+
+
+@contextmanager
+def timeout_scope(timeout):
+    """ Use timeout, in seconds or as a (connect, read) tuple, instead of
+    the client's for the requests made on this thread inside the block.
+    None keeps the client's timeout. """
+    previous = current_timeout()
+    _local.timeout = timeout
+    try:
+        yield timeout
+    finally:
+        _local.timeout = previous
+
+
+def check_deadline():
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+def request_timeout(timeout):
+    """ requests timeout for the next call: the configured (connect, read)
+    timeout, or the active override, shortened to the time left before the
+    active deadline. """
+    if current_timeout() is not None:
+        timeout = current_timeout()
+    deadline = current_deadline()
+    if deadline is None:
+        return timeout
+    deadline.check()
+    remaining = deadline.remaining()
+    if remaining is None:
+        return timeout
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    return tuple(remaining if value is None else min(value, remaining)
+                 for value in timeout)
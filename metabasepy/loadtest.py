@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+""" Record traffic made through a Client and replay it against a local
+stand-in server to measure throughput and latency. """
+import base64
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from metabasepy.utils import percentile
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# response headers worth replaying, the rest are recomputed by the server
+REPLAYED_HEADERS = ('Content-Type', 'Content-Disposition')
+
+# credentials are never written to a cassette
+REDACTED = "REDACTED"
+REDACTED_FIELDS = ('password', 'old_password')
+SESSION_PATH = '/api/session'
+
+
+def endpoint_label(method, path):
+    """ Group requests by resource method, eg. "GET /api/card/{id}". """
+    path = path.split('?', 1)[0]
+    return "{} {}".format(method, re.sub(r'/\d+(?=/|$)', '/{id}', path))
+
+
+def redact_fields(data):
+    """ Copy of decoded json with the values of REDACTED_FIELDS replaced. """
+    if isinstance(data, dict):
+        return {key: REDACTED if key in REDACTED_FIELDS
+                else redact_fields(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [redact_fields(value) for value in data]
+    return data
+
+
+def redact_body(body, path, is_response=False):
+    """ Remove passwords from a json body, and the session id from the
+    response of a login. Bodies which are not json are kept as is. """
+    if not body:
+        return body
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return body
+    redacted = redact_fields(data)
+    if is_response and path.split('?', 1)[0] == SESSION_PATH and \
+            isinstance(redacted, dict) and 'id' in redacted:
+        redacted['id'] = REDACTED
+    if redacted == data:
+        return body
+    return json.dumps(redacted).encode('utf-8')
+
+
+def encode_body(body):
+    return base64.b64encode(body).decode('ascii') if body else None
+
+
+class RecordingSession(requests.Session):
+    """ requests session that keeps every request/response pair it sends.
+
+    Pass it to Client(session=...) to capture the traffic of a workload,
+    then save it as a cassette file with save(). Passwords and login
+    session ids are redacted.
+
+    Streamed responses are left for the caller to read, their body is
+    recorded once it has been read to the end, otherwise it is replayed
+    empty. """
+
+    def __init__(self):
+        super(RecordingSession, self).__init__()
+        self.entries = []
+        self._lock = threading.Lock()
+        self._started_at = None
+        # streamed responses whose body may still be read
+        self._streamed = []
+
+    def request(self, method, url, *args, **kwargs):
+        started_at = time.time()
+        resp = super(RecordingSession, self).request(method, url, *args,
+                                                     **kwargs)
+        body = resp.request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        split_url = urlsplit(resp.request.url)
+        path = split_url.path
+        if split_url.query:
+            path = "{}?{}".format(path, split_url.query)
+
+        entry = {
+            "method": resp.request.method,
+            "path": path,
+            "request_headers": {
+                'Content-Type': resp.request.headers.get('Content-Type')
+            },
+            "request_body": encode_body(redact_body(body, path)),
+            "status": resp.status_code,
+            "response_headers": {
+                key: resp.headers[key] for key in REPLAYED_HEADERS
+                if key in resp.headers
+            },
+            "response_body": None,
+            "elapsed": resp.elapsed.total_seconds()
+        }
+        if kwargs.get('stream'):
+            RecordingSession._record_stream(resp, entry)
+            with self._lock:
+                self._streamed.append((entry, resp))
+        else:
+            entry["response_body"] = encode_body(
+                redact_body(resp.content, path, is_response=True))
+
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = started_at
+            entry["offset"] = started_at - self._started_at
+            self.entries.append(entry)
+        return resp
+
+    @staticmethod
+    def _record_stream(resp, entry):
+        """ Record the body of a streamed response while the caller reads
+        it, without buffering it ahead of the caller. """
+        iter_content = resp.iter_content
+
+        def recording_iter_content(chunk_size=1, decode_unicode=False):
+            chunks = []
+
+            def read():
+                for chunk in iter_content(chunk_size=chunk_size):
+                    chunks.append(chunk)
+                    yield chunk
+                entry["response_body"] = encode_body(redact_body(
+                    b''.join(chunks), entry["path"], is_response=True))
+
+            if decode_unicode:
+                return requests.utils.stream_decode_response_unicode(
+                    read(), resp)
+            return read()
+
+        resp.iter_content = recording_iter_content
+
+    def save(self, path):
+        with self._lock:
+            for entry, resp in self._streamed:
+                # bodies read in one go, eg. by send_request under a
+                # deadline, did not go through iter_content
+                if entry["response_body"] is None and \
+                        isinstance(resp._content, bytes):
+                    entry["response_body"] = encode_body(redact_body(
+                        resp._content, entry["path"], is_response=True))
+            entries = sorted(self.entries, key=lambda e: e["offset"])
+        with open(path, 'w') as f:
+            json.dump({"entries": entries}, f)
+
+
+def load_cassette(path):
+    with open(path, 'r') as f:
+        return json.load(f)["entries"]
+
+
+class ReplayServer(object):
+    """ Local http server answering with the responses of a cassette.
+
+    Responses are matched by method and path, repeated requests to the same
+    path get the recorded responses in order, cycling at the end. With
+    server_latency each response is delayed by its recorded duration. """
+
+    def __init__(self, entries, host='127.0.0.1', port=0,
+                 server_latency=False):
+        self.server_latency = server_latency
+        self._responses = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        for entry in entries:
+            key = (entry["method"], entry["path"])
+            self._responses.setdefault(key, []).append(entry)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def next_response(self, method, path):
+        key = (method, path)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                return None
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+        return responses[position % len(responses)]
+
+    def _handler(self):
+        replay_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, do not let the
+            # body wait for a delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _replay(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                entry = replay_server.next_response(self.command, self.path)
+                if entry is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if replay_server.server_latency:
+                    time.sleep(entry["elapsed"])
+                body = base64.b64decode(entry["response_body"] or '')
+                self.send_response(entry["status"])
+                for key, value in entry["response_headers"].items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _replay
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def replay(cassette_path, concurrency=4, speed=1.0, repeat=1,
+           server_latency=False):
+    """ Replay a recorded workload against a local ReplayServer.
+
+    :param cassette_path: file written by RecordingSession.save
+    :param concurrency: number of requests in flight at most
+    :param speed: multiplier applied to the recorded request pacing,
+        0 sends requests as fast as the concurrency allows
+    :param repeat: how many times the workload is played
+    :param server_latency: make the stand-in server take as long as the
+        recorded responses did
+    :return: dict of endpoint label to count, errors, throughput and
+        latency percentiles in seconds
+    """
+    entries = load_cassette(cassette_path)
+    server = ReplayServer(entries, server_latency=server_latency).start()
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(entry):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        body = entry["request_body"]
+        label = endpoint_label(entry["method"], entry["path"])
+        started_at = time.time()
+        try:
+            resp = session.request(
+                method=entry["method"],
+                url=server.base_url + entry["path"],
+                data=base64.b64decode(body) if body else None,
+                headers={key: value for key, value in
+                         entry["request_headers"].items() if value}
+            )
+            failed = resp.status_code != entry["status"]
+        except requests.RequestException:
+            failed = True
+        latency = time.time() - started_at
+        with lock:
+            latencies.setdefault(label, []).append(latency)
+            if failed:
+                errors[label] = errors.get(label, 0) + 1
+
+    workload = entries * repeat
+    duration = entries[-1]["offset"] if entries else 0
+    started_at = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for index, entry in enumerate(workload):
+                if speed:
+                    offset = entry["offset"] + \
+                        duration * (index // len(entries))
+                    delay = started_at + offset / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(send, entry)
+        # measured before the server shutdown, which can take a while
+        total_time = time.time() - started_at
+    finally:
+        server.stop()
+
+    report = {}
+    for label, values in latencies.items():
+        values.sort()
+        report[label] = {
+            "count": len(values),
+            "errors": errors.get(label, 0),
+            "throughput": len(values) / total_time if total_time else None,
+            "p50": percentile(values, 0.50),
+            "p90": percentile(values, 0.90),
+            "p99": percentile(values, 0.99),
+            "max": values[-1]
+        }
+    return report
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+""" Compact objects for resource responses.
+
+Large nested fields are kept as compact json bytes and decoded the first
+time they are read, everything else is kept in a plain dict. """
+import json
+
+
+class Model(object):
+    __slots__ = ('_fields', '_encoded')
+
+    # nested fields kept encoded until first access
+    HEAVY_FIELDS = ()
+
+    def __init__(self, data):
+        fields = dict(data)
+        encoded = {}
+        for name in self.HEAVY_FIELDS:
+            if name in fields:
+                encoded[name] = json.dumps(
+                    fields.pop(name), separators=(',', ':')).encode('utf-8')
+        self._fields = fields
+        self._encoded = encoded
+
+    @classmethod
+    def from_json(cls, raw):
+        return cls(json.loads(raw))
+
+    @classmethod
+    def build(cls, data):
+        """ Model of a response object, or a list of models for a list.
+
+        Paginated listings ({"data": [...], "total": ...}) keep their
+        envelope with the items of data turned into models. """
+        if isinstance(data, list):
+            return [cls(item) for item in data]
+        if 'id' not in data and isinstance(data.get('data'), list):
+            return dict(data, data=cls.build(data['data']))
+        return cls(data)
+
+    def __getitem__(self, name):
+        raw = self._encoded.get(name)
+        if raw is not None:
+            # stored before the encoded copy is dropped, so a concurrent
+            # reader finds the field in one place or the other
+            value = self._fields.setdefault(name, json.loads(raw))
+            self._encoded.pop(name, None)
+            return value
+        return self._fields[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self._fields or name in self._encoded
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._fields) + list(self._encoded)
+
+    def to_dict(self):
+        return {name: self[name] for name in self.keys()}
+
+    def __repr__(self):
+        return "<{} id={!r} name={!r}>".format(
+            type(self).__name__, self._fields.get('id'),
+            self._fields.get('name', self._fields.get('email')))
+
+
+class Card(Model):
+    __slots__ = ()
+    HEAVY_FIELDS = ('result_metadata', 'visualization_settings',
+                    'dataset_query', 'parameters', 'parameter_mappings',
+                    'embedding_params', 'collection', 'creator',
+                    'last-edit-info')
+
+
+class Collection(Model):
+    __slots__ = ()
+    HEAVY_FIELDS = ('effective_ancestors',)
+
+
+class Database(Model):
+    __slots__ = ()
+    HEAVY_FIELDS = ('details', 'features', 'tables', 'settings',
+                    'schedules', 'native_permissions')
+
+
+class User(Model):
+    __slots__ = ()
+    HEAVY_FIELDS = ('login_attributes', 'user_group_memberships',
+                    'group_ids')
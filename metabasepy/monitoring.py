@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+""" Background sampling of server stats into a fixed-size history. """
+import json
+import math
+import threading
+import time
+from array import array
+
+from metabasepy.utils import percentile
+
+
+def flatten_numbers(data, prefix=''):
+    """ Flatten nested dicts into {"a.b.c": number} keeping numeric leaves. """
+    flat = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            name = "{}.{}".format(prefix, key) if prefix else str(key)
+            flat.update(flatten_numbers(value, name))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        flat[prefix] = float(data)
+    return flat
+
+
+class RingBuffer(object):
+    """ Fixed-size history of samples stored in compact double arrays.
+
+    Every sample shares one timestamp, metrics missing from a sample are
+    stored as NaN. """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', [math.nan] * capacity)
+        self.series = {}
+        self.count = 0
+
+    def append(self, timestamp, values):
+        position = self.count % self.capacity
+        self.timestamps[position] = timestamp
+        for name in values:
+            if name not in self.series:
+                self.series[name] = array('d', [math.nan] * self.capacity)
+        for name, series in self.series.items():
+            series[position] = values.get(name, math.nan)
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def ordered(self, values):
+        if self.count <= self.capacity:
+            return list(values[:self.count])
+        position = self.count % self.capacity
+        return list(values[position:]) + list(values[:position])
+
+    def window(self, name, seconds=None):
+        """ (timestamp, value) pairs of a metric, oldest first. """
+        pairs = zip(self.ordered(self.timestamps),
+                    self.ordered(self.series[name]))
+        pairs = [(t, v) for t, v in pairs if not math.isnan(v)]
+        if seconds is not None and pairs:
+            since = pairs[-1][0] - seconds
+            pairs = [(t, v) for t, v in pairs if t >= since]
+        return pairs
+
+
+class StatsSampler(object):
+    """ Polls UtilityResource.stats and connection_pool_info on a background
+    thread and keeps the last capacity samples.
+
+    Metric names are the dotted paths of numeric values in the responses,
+    prefixed with "stats." or "pool.". """
+
+    def __init__(self, utils, interval=60.0, capacity=1440, stats=True,
+                 connection_pool_info=True):
+        self.utils = utils
+        self.interval = interval
+        self.sources = []
+        if stats:
+            self.sources.append(('stats', utils.stats))
+        if connection_pool_info:
+            self.sources.append(('pool', utils.connection_pool_info))
+        self.buffer = RingBuffer(capacity=capacity)
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """ Poll the sources once and store the result. """
+        values = {}
+        for prefix, fetch in self.sources:
+            try:
+                values.update(flatten_numbers(fetch(), prefix))
+            except Exception:
+                self.errors += 1
+        with self._lock:
+            self.buffer.append(time.time(), values)
+
+    def _run(self):
+        while not self._stop.is_set():
+            started_at = time.time()
+            self.sample()
+            elapsed = time.time() - started_at
+            self._stop.wait(max(0, self.interval - elapsed))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return sorted(self.buffer.series)
+
+    def aggregate(self, name, seconds=None):
+        """ Rolling aggregates of a metric over the last seconds (or the
+        whole history). rate is the change per second between the first
+        and last sample, meaningful for counters. """
+        with self._lock:
+            pairs = self.buffer.window(name, seconds=seconds)
+        if not pairs:
+            return None
+        values = sorted(v for _, v in pairs)
+        (first_t, first_v), (last_t, last_v) = pairs[0], pairs[-1]
+        return {
+            "count": len(values),
+            "last": last_v,
+            "min": values[0],
+            "max": values[-1],
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.50),
+            "p90": percentile(values, 0.90),
+            "p99": percentile(values, 0.99),
+            "rate": (last_v - first_v) / (last_t - first_t)
+            if last_t > first_t else None
+        }
+
+    def snapshot(self, seconds=None):
+        return {name: self.aggregate(name, seconds=seconds)
+                for name in self.metrics}
+
+    def dump(self, path):
+        """ Write the raw history as json. """
+        with self._lock:
+            data = {
+                "timestamps": self.buffer.ordered(self.buffer.timestamps),
+                "series": {
+                    name: [None if math.isnan(v) else v
+                           for v in self.buffer.ordered(series)]
+                    for name, series in self.buffer.series.items()
+                }
+            }
+        with open(path, 'w') as f:
+            json.dump(data, f)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+""" Keep results of frequently used cards warm in a local cache. """
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metabasepy.client import SingleFlight
+
+
+class CardRefresher(object):
+    """ Re-runs hot cards in the background and serves their latest result.
+
+    Cards registered with add() are kept warm: once started, get() answers
+    from the cache right away, even when the result is older than
+    interval, and stale entries are refreshed in the background on at most
+    max_workers threads. Cards only asked for through get() are cached too,
+    at most max_cached of them (least recently used are dropped), but are
+    only refreshed when get() finds them stale, never by the background
+    loop. When the refresher is not running, stale entries are refreshed on
+    the calling thread instead. Concurrent fetches of the same card share
+    one request.
+
+    A failed refresh keeps the previous result and stores the exception in
+    the entry's "error". It is retried after interval, doubling the wait on
+    every further failure up to max_backoff seconds. """
+
+    def __init__(self, client, interval=60.0, max_workers=4, max_cached=256,
+                 max_backoff=3600.0):
+        self.client = client
+        self.interval = interval
+        self.max_workers = max_workers
+        self.max_cached = max_cached
+        self.max_backoff = max_backoff
+        self.entries = {}
+        self._cached_keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def key(card_id, parameters=None):
+        return card_id, json.dumps(parameters, sort_keys=True)
+
+    def _entry(self, card_id, parameters, registered):
+        """ Entry of the card, created when missing. Called with the lock
+        held. """
+        key = CardRefresher.key(card_id, parameters)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {
+                "card_id": card_id,
+                "parameters": parameters,
+                "result": None,
+                "error": None,
+                "fetched_at": None,
+                "failed_at": None,
+                "failures": 0,
+                "refreshing": False,
+                "registered": registered
+            }
+        if registered and not entry["registered"]:
+            entry["registered"] = True
+            self._cached_keys.pop(key, None)
+        elif not entry["registered"]:
+            self._cached_keys[key] = True
+            self._cached_keys.move_to_end(key)
+            while len(self._cached_keys) > self.max_cached:
+                evicted, _ = self._cached_keys.popitem(last=False)
+                del self.entries[evicted]
+        return key, entry
+
+    def add(self, card_id, parameters=None):
+        """ Register a card and parameter set to keep warm. """
+        with self._lock:
+            key, _ = self._entry(card_id, parameters, registered=True)
+        return key
+
+    def remove(self, card_id, parameters=None):
+        """ Stop keeping a card warm and drop its cached result. """
+        key = CardRefresher.key(card_id, parameters)
+        with self._lock:
+            self.entries.pop(key, None)
+            self._cached_keys.pop(key, None)
+
+    def _retry_at(self, entry):
+        if not entry["failures"]:
+            return None
+        backoff = min(self.interval * 2 ** (entry["failures"] - 1),
+                      max(self.max_backoff, self.interval))
+        return entry["failed_at"] + backoff
+
+    def _is_stale(self, entry):
+        """ Whether the entry should be refreshed now. """
+        now = time.time()
+        retry_at = self._retry_at(entry)
+        if retry_at is not None:
+            return now >= retry_at
+        return entry["fetched_at"] is None or \
+            now - entry["fetched_at"] >= self.interval
+
+    def refresh(self, key):
+        """ Run the card now and store its result. """
+        with self._lock:
+            entry = self.entries[key]
+
+        def fetch():
+            try:
+                result = self.client.cards.query(
+                    card_id=entry["card_id"], parameters=entry["parameters"])
+            except Exception as ex:
+                with self._lock:
+                    entry["error"] = ex
+                    entry["failed_at"] = time.time()
+                    entry["failures"] += 1
+                    entry["refreshing"] = False
+                raise
+            with self._lock:
+                entry["result"] = result
+                entry["error"] = None
+                entry["fetched_at"] = time.time()
+                entry["failed_at"] = None
+                entry["failures"] = 0
+                entry["refreshing"] = False
+            return result
+
+        return self._flight.do(key=key, fn=fetch)
+
+    def _refresh_quietly(self, key):
+        try:
+            self.refresh(key)
+        except Exception:
+            # the error is kept on the entry, the stale result stays served
+            pass
+
+    def _schedule(self, key):
+        """ Submit a background refresh unless one is already running, or
+        refresh on this thread when the refresher was not started. """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["refreshing"]:
+                return
+            if self._executor is not None:
+                # submitted under the lock, stop() can't shut it down first
+                entry["refreshing"] = True
+                self._executor.submit(self._refresh_quietly, key)
+                return
+        self._refresh_quietly(key)
+
+    def get(self, card_id, parameters=None):
+        """ Latest result of the card, fetched synchronously when it has
+        never been fetched or when the refresher is not running.
+
+        Raises the last error while a card that never succeeded waits for
+        its next retry. """
+        with self._lock:
+            key, entry = self._entry(card_id, parameters, registered=False)
+            has_result = entry["fetched_at"] is not None
+            stale = self._is_stale(entry)
+            error = entry["error"]
+        if not has_result:
+            if not stale:
+                raise error
+            return self.refresh(key)
+        if stale:
+            self._schedule(key)
+        with self._lock:
+            return entry["result"]
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                stale_keys = [key for key, entry in self.entries.items()
+                              if entry["registered"] and
+                              self._is_stale(entry)]
+            for key in stale_keys:
+                self._schedule(key)
+            self._stop.wait(min(self.interval, 1.0))
+
+    def start(self):
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+""" Run batches of native queries ordered by their expected cost. """
+import hashlib
+import json
+import os
+import threading
+import time
+
+from metabasepy.client import RequestException, execute_concurrently
+from metabasepy.deadline import (
+    DeadlineExceeded,
+    current_deadline,
+    current_timeout,
+    deadline_scope,
+    timeout_scope
+)
+
+SHORTEST_FIRST = 'shortest'
+DEADLINE_FIRST = 'deadline'
+
+
+class QueryHistory(object):
+    """ Local record of past query execution times in seconds, kept as an
+    exponential moving average per (database_id, query). """
+
+    def __init__(self, path=None, smoothing=0.5):
+        self.path = path
+        self.smoothing = smoothing
+        self.durations = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.durations = json.load(f)
+
+    @staticmethod
+    def key(database_id, query):
+        digest = hashlib.sha1(query.encode('utf-8')).hexdigest()
+        return "{}:{}".format(database_id, digest)
+
+    def get(self, database_id, query):
+        return self.durations.get(QueryHistory.key(database_id, query))
+
+    def record(self, database_id, query, seconds):
+        key = QueryHistory.key(database_id, query)
+        with self._lock:
+            previous = self.durations.get(key)
+            if previous is not None:
+                seconds = (self.smoothing * seconds +
+                           (1 - self.smoothing) * previous)
+            self.durations[key] = seconds
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            content = json.dumps(self.durations)
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+
+class QueryScheduler(object):
+    """ Executes queued queries through DatasetCommand.post, cheapest or most
+    urgent first, with at most per_database_concurrency queries running on
+    the same database at once. An AdaptiveConcurrencyLimiter can further
+    limit how many queries run in total.
+
+    Costs come from the local history when present, otherwise from the
+    server's /api/dataset/duration, asked for every query concurrently.
+    Queries with unknown cost, or whose estimate failed, run last.
+    Queries still queued when the caller's deadline passes are not run. """
+
+    def __init__(self, client, history_path=None, max_workers=8,
+                 per_database_concurrency=2, order=SHORTEST_FIRST,
+                 limiter=None):
+        if order not in (SHORTEST_FIRST, DEADLINE_FIRST):
+            raise ValueError('{} order not supported!'.format(order))
+        self.client = client
+        self.history = QueryHistory(path=history_path)
+        self.max_workers = max_workers
+        self.per_database_concurrency = per_database_concurrency
+        self.order = order
+        self.limiter = limiter
+        self.jobs = []
+
+    def add(self, database_id, query, deadline=None):
+        """
+        :param deadline: unix timestamp the query should finish by, used
+            with the deadline order
+        """
+        self.jobs.append({
+            "index": len(self.jobs),
+            "database_id": database_id,
+            "query": query,
+            "deadline": deadline,
+            "estimated": None
+        })
+
+    def estimate(self, database_id, query):
+        """ Expected execution time in seconds, or None if unknown. """
+        seconds = self.history.get(database_id, query)
+        if seconds is not None:
+            return seconds
+        try:
+            response = self.client.dataset.duration(database_id=database_id,
+                                                    query=query)
+        except RequestException:
+            return None
+        average = response.get('average') if response else None
+        if average is None:
+            return None
+        return average / 1000.0
+
+    def _sort_key(self, job):
+        estimated = job["estimated"]
+        cost = (estimated is None, estimated or 0)
+        if self.order == DEADLINE_FIRST:
+            return (job["deadline"] is None, job["deadline"] or 0) + cost
+        return cost
+
+    def run(self):
+        """ Execute every queued query.
+
+        :return: list of reports in the order queries were added, with
+            "ok", "result", "error", "estimated" and "elapsed" keys
+        """
+        jobs, self.jobs = self.jobs, []
+        # a failed estimate only sends its query to the back of the queue
+        estimates = execute_concurrently(
+            self.estimate,
+            [{"database_id": job["database_id"], "query": job["query"]}
+             for job in jobs],
+            max_workers=self.max_workers)
+        for job, estimate in zip(jobs, estimates):
+            job["estimated"] = estimate["result"]
+        pending = sorted(jobs, key=self._sort_key)
+        running = {}
+        reports = [None] * len(jobs)
+        condition = threading.Condition()
+        deadline = current_deadline()
+        timeout = current_timeout()
+
+        def next_job():
+            for position, job in enumerate(pending):
+                database_id = job["database_id"]
+                if running.get(database_id, 0) < \
+                        self.per_database_concurrency:
+                    running[database_id] = running.get(database_id, 0) + 1
+                    return pending.pop(position)
+            return None
+
+        def worker():
+            while True:
+                with condition:
+                    job = next_job()
+                    while job is None:
+                        if not pending:
+                            return
+                        condition.wait()
+                        job = next_job()
+
+                report = {
+                    "database_id": job["database_id"],
+                    "query": job["query"],
+                    "estimated": job["estimated"],
+                    "ok": True,
+                    "result": None,
+                    "error": None
+                }
+                report["elapsed"] = None
+                if deadline is not None and deadline.expired:
+                    # drop queued work once the deadline is gone
+                    report["ok"] = False
+                    report["error"] = DeadlineExceeded("deadline exceeded")
+                else:
+                    if self.limiter is not None:
+                        self.limiter.acquire()
+                    started_at = time.time()
+                    try:
+                        with deadline_scope(deadline), \
+                                timeout_scope(timeout):
+                            report["result"] = self.client.dataset.post(
+                                database_id=job["database_id"],
+                                query=job["query"])
+                    except Exception as ex:
+                        report["ok"] = False
+                        report["error"] = ex
+                    report["elapsed"] = time.time() - started_at
+                    if self.limiter is not None:
+                        self.limiter.release(
+                            latency=report["elapsed"], ok=report["ok"],
+                            key=QueryHistory.key(job["database_id"],
+                                                 job["query"]))
+                if report["ok"]:
+                    self.history.record(job["database_id"], job["query"],
+                                        report["elapsed"])
+                reports[job["index"]] = report
+
+                with condition:
+                    running[job["database_id"]] -= 1
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.max_workers, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.history.save()
+        return reports
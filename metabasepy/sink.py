@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+""" Copy card inventories and query results into a local SQLite file. """
+import json
+import sqlite3
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import islice
+
+SQLITE_TYPES = {
+    'type/Integer': 'INTEGER',
+    'type/BigInteger': 'INTEGER',
+    'type/Boolean': 'INTEGER',
+    'type/Float': 'REAL',
+    # NUMERIC affinity would turn decimal text back into lossy REAL values
+    'type/Decimal': 'TEXT',
+}
+
+CARD_COLUMNS = [
+    ('id', 'INTEGER'),
+    ('name', 'TEXT'),
+    ('description', 'TEXT'),
+    ('collection_id', 'INTEGER'),
+    ('database_id', 'INTEGER'),
+    ('display', 'TEXT'),
+    ('query_type', 'TEXT'),
+    ('native_query', 'TEXT'),
+    ('archived', 'INTEGER'),
+    ('created_at', 'TEXT'),
+    ('updated_at', 'TEXT'),
+    ('raw', 'TEXT'),
+]
+
+COLLECTION_COLUMNS = [
+    ('id', ''),  # the root collection has the id "root"
+    ('name', 'TEXT'),
+    ('slug', 'TEXT'),
+    ('description', 'TEXT'),
+    ('color', 'TEXT'),
+    ('location', 'TEXT'),
+    ('archived', 'INTEGER'),
+    ('raw', 'TEXT'),
+]
+
+
+def quote_identifier(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def to_sqlite_value(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if hasattr(value, 'to_dict'):
+        value = value.to_dict()
+    return json.dumps(value)
+
+
+def card_record(card):
+    dataset_query = card.get('dataset_query') or {}
+    native = dataset_query.get('native') or {}
+    raw = card.to_dict() if hasattr(card, 'to_dict') else card
+    return {
+        'id': card.get('id'),
+        'name': card.get('name'),
+        'description': card.get('description'),
+        'collection_id': card.get('collection_id'),
+        'database_id': card.get('database_id'),
+        'display': card.get('display'),
+        'query_type': card.get('query_type') or dataset_query.get('type'),
+        'native_query': native.get('query'),
+        'archived': card.get('archived'),
+        'created_at': card.get('created_at'),
+        'updated_at': card.get('updated_at'),
+        'raw': raw,
+    }
+
+
+def collection_record(collection):
+    raw = collection.to_dict() if hasattr(collection, 'to_dict') \
+        else collection
+    record = {name: collection.get(name)
+              for name, _ in COLLECTION_COLUMNS if name != 'raw'}
+    record['raw'] = raw
+    return record
+
+
+class SQLiteSink(object):
+    """ Writes rows with executemany in batches of batch_size, every write
+    call runs in a single transaction. Tables are created on first write
+    and rows sharing a primary key are replaced. """
+
+    def __init__(self, path, batch_size=5000):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    def create_table(self, table_name, columns, primary_key=None):
+        definitions = []
+        for name, sql_type in columns:
+            parts = [quote_identifier(name), sql_type]
+            if name == primary_key:
+                parts.append("PRIMARY KEY")
+            definitions.append(" ".join(part for part in parts if part))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+            quote_identifier(table_name), ", ".join(definitions)))
+
+    def write_rows(self, table_name, column_names, rows):
+        """ Insert (or replace) rows given as sequences in column order.
+
+        :return: number of rows written
+        """
+        statement = "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+            quote_identifier(table_name),
+            ", ".join(quote_identifier(name) for name in column_names),
+            ", ".join("?" * len(column_names)))
+        rows = iter(rows)
+        written = 0
+        with self.connection:
+            while True:
+                batch = [[to_sqlite_value(value) for value in row]
+                         for row in islice(rows, self.batch_size)]
+                if not batch:
+                    break
+                self.connection.executemany(statement, batch)
+                written += len(batch)
+        return written
+
+    def write_records(self, table_name, columns, records, primary_key='id'):
+        """ Write dicts into a table described by (name, sql type) pairs. """
+        self.create_table(table_name, columns, primary_key=primary_key)
+        column_names = [name for name, _ in columns]
+        return self.write_rows(
+            table_name, column_names,
+            ([record.get(name) for name in column_names]
+             for record in records))
+
+    def write_cards(self, cards, table_name='cards'):
+        """ Store a CardResource.get listing, upserting on card id. """
+        return self.write_records(table_name, CARD_COLUMNS,
+                                  (card_record(card) for card in cards))
+
+    def write_collections(self, collections, table_name='collections'):
+        """ Store a CollectionResource.get listing, upserting on id. """
+        return self.write_records(
+            table_name, COLLECTION_COLUMNS,
+            (collection_record(collection) for collection in collections))
+
+    def write_table(self, table, table_name, primary_key=None):
+        """ Store the rows of a MetabaseTable, the schema is taken from its
+        cols. Rows are upserted when primary_key names one of the columns.
+        """
+        column_names = []
+        for col in table.cols:
+            name = col.get('name')
+            suffix = 1
+            unique_name = name
+            while unique_name in column_names:
+                suffix += 1
+                unique_name = "{}_{}".format(name, suffix)
+            column_names.append(unique_name)
+        columns = [(name, SQLITE_TYPES.get(col.get('base_type'), 'TEXT'))
+                   for name, col in zip(column_names, table.cols)]
+        if primary_key is not None and primary_key not in column_names:
+            raise ValueError('{} is not a column!'.format(primary_key))
+        self.create_table(table_name, columns, primary_key=primary_key)
+        return self.write_rows(table_name, column_names, table.rows)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,20 @@
 # -*- coding: utf-8 -*-
+import csv
+import io
+import json
+import mmap
+import os
+import pickle
+import re
+import tempfile
+from array import array
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = "mertsalik"
 __copyright__ = "Copyright 2018"
@@ -11,13 +27,357 @@ class MetabaseResultInvalidException(Exception):
     pass
 
 
+def parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    # fromisoformat only accepts "Z" from python 3.11 on
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.fromisoformat(value)
+
+
+def parse_date(value):
+    if isinstance(value, date):
+        return value
+    return parse_datetime(value).date() if 'T' in value \
+        else date.fromisoformat(value)
+
+
+def parse_boolean(value):
+    if isinstance(value, str):
+        return value.lower() in ('true', 't', '1', 'yes')
+    return bool(value)
+
+
+DEFAULT_CONVERTERS = {
+    'type/DateTime': parse_datetime,
+    'type/DateTimeWithTZ': parse_datetime,
+    'type/DateTimeWithLocalTZ': parse_datetime,
+    'type/Date': parse_date,
+    'type/Decimal': lambda value: Decimal(str(value)),
+    'type/Boolean': parse_boolean,
+    'type/Float': float,
+    'type/Integer': int,
+    'type/BigInteger': int,
+}
+
+# converters numpy can apply to a whole column with a single cast
+VECTORIZED_DTYPES = {
+    float: 'float64',
+    int: 'int64',
+}
+
+
+def convert_column(values, converter):
+    """ Apply converter to every value of a column, leaving nulls as is. """
+    dtype = VECTORIZED_DTYPES.get(converter)
+    if numpy is not None and dtype and None not in values:
+        try:
+            return numpy.asarray(values).astype(dtype).tolist()
+        except (TypeError, ValueError, OverflowError):
+            # fall back to the per value conversion for mixed columns and
+            # integers beyond int64
+            pass
+    return [None if value is None else converter(value) for value in values]
+
+
+class SpillingRows(object):
+    """ List-like row store which keeps the first max_memory_rows rows in
+    memory and appends the rest to a temporary file on disk.
+
+    Spilled rows are pickled one after another, their offsets are kept in a
+    compact array so any row can be read back with a single seek. """
+
+    def __init__(self, max_memory_rows, rows=None, spill_dir=None):
+        self.max_memory_rows = max_memory_rows
+        self.spill_dir = spill_dir
+        self._memory_rows = []
+        self._offsets = array('q')
+        self._spill_file = None
+        if rows is not None:
+            self.extend(rows)
+
+    def append(self, row):
+        if len(self._memory_rows) < self.max_memory_rows:
+            self._memory_rows.append(row)
+            return
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        self._spill_file.seek(0, 2)
+        self._offsets.append(self._spill_file.tell())
+        self._spill_file.write(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    @property
+    def spilled_count(self):
+        return len(self._offsets)
+
+    def _read_spilled(self, index):
+        self._spill_file.seek(self._offsets[index])
+        return pickle.load(self._spill_file)
+
+    def __len__(self):
+        return len(self._memory_rows) + len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        memory_count = len(self._memory_rows)
+        if index < memory_count:
+            return self._memory_rows[index]
+        return self._read_spilled(index - memory_count)
+
+    def __iter__(self):
+        for row in self._memory_rows:
+            yield row
+        # seek on every row, the file position is shared with indexing and
+        # with other iterators
+        for index in range(len(self._offsets)):
+            yield self._read_spilled(index)
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        self._offsets = array('q')
+
+    def __del__(self):
+        self.close()
+
+
+class ColumnRows(object):
+    """ Read-only, list-like row view over values stored column by column.
+    """
+
+    def __init__(self, columns, row_count):
+        self.columns = columns
+        self.row_count = row_count
+
+    def __len__(self):
+        return self.row_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        return [column[index] for column in self.columns]
+
+    def __iter__(self):
+        for row in zip(*self.columns):
+            yield list(row)
+
+
+INDEX_VERSION = 2
+INDEX_SUFFIX = ".idx"
+
+CSV_TOKENS = re.compile(br'["\n]')
+JSON_TOKENS = re.compile(br'[{}"\\]')
+
+
+def build_csv_index(data, start):
+    """ Start and end offsets of every csv record from start on. A newline
+    ends a record only when it is outside of quotes, blank lines (including
+    a lone \\r of crlf files) are skipped. """
+    starts, ends = array('q'), array('q')
+    record_start = start
+    in_quotes = False
+    for match in CSV_TOKENS.finditer(data, start):
+        if match.group() == b'"':
+            in_quotes = not in_quotes
+            continue
+        if in_quotes:
+            continue
+        position = match.start()
+        if data[record_start:position].strip():
+            starts.append(record_start)
+            ends.append(position)
+        record_start = position + 1
+    if data[record_start:].strip():
+        starts.append(record_start)
+        ends.append(len(data))
+    return starts, ends
+
+
+def build_json_index(data):
+    """ Start and end offsets of the objects in a top level json list. """
+    starts, ends = array('q'), array('q')
+    depth = 0
+    in_string = False
+    escaped_at = -1
+    for match in JSON_TOKENS.finditer(data):
+        position = match.start()
+        token = match.group()
+        if in_string:
+            if token == b'\\' and escaped_at != position:
+                escaped_at = position + 1
+            elif token == b'"' and escaped_at != position:
+                in_string = False
+        elif token == b'"':
+            in_string = True
+        elif token == b'{':
+            if depth == 0:
+                starts.append(position)
+            depth += 1
+        elif token == b'}':
+            depth -= 1
+            if depth == 0:
+                ends.append(position + 1)
+    return starts, ends
+
+
+class MappedRows(object):
+    """ Read-only rows of an exported csv or json file, parsed on access
+    from a memory map. The mapped pages are shared by every process that
+    opens the same file.
+
+    The record offsets are computed once and saved next to the file with
+    the INDEX_SUFFIX extension, they are rebuilt when the file changes. """
+
+    def __init__(self, path, file_format=None):
+        self.path = path
+        self.file_format = file_format or \
+            os.path.splitext(path)[1].lstrip('.').lower()
+        if self.file_format not in ('csv', 'json'):
+            raise ValueError('{} not supported!'.format(self.file_format))
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._signature = [INDEX_VERSION, stat.st_size, stat.st_mtime_ns]
+        self._data = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ) \
+            if stat.st_size else b''
+        self.header = None
+        self.starts, self.ends = self._load_index()
+        if self.file_format == 'csv' and len(self.starts):
+            self.header = self._parse_csv(0)
+            # the header is the first record
+            self.starts, self.ends = self.starts[1:], self.ends[1:]
+        elif len(self.starts):
+            self.header = list(self._parse_json_object(0).keys())
+
+    @property
+    def index_path(self):
+        return self.path + INDEX_SUFFIX
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                signature = array('q')
+                signature.fromfile(f, 4)
+                if list(signature[:3]) == self._signature:
+                    count = signature[3]
+                    starts, ends = array('q'), array('q')
+                    starts.fromfile(f, count)
+                    ends.fromfile(f, count)
+                    return starts, ends
+        except (IOError, OSError, EOFError):
+            pass
+        if self.file_format == 'csv':
+            # skip a utf-8 byte order mark
+            start = 3 if self._data[:3] == b'\xef\xbb\xbf' else 0
+            starts, ends = build_csv_index(self._data, start)
+        else:
+            starts, ends = build_json_index(self._data)
+        self._save_index(starts, ends)
+        return starts, ends
+
+    def _save_index(self, starts, ends):
+        tmp_path = "{}.tmp-{}".format(self.index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                array('q', self._signature + [len(starts)]).tofile(f)
+                starts.tofile(f)
+                ends.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        except (IOError, OSError):
+            # a read-only directory only costs the index rebuild next time
+            pass
+
+    def _record(self, position):
+        return self._data[self.starts[position]:self.ends[position]]
+
+    def _parse_csv(self, position):
+        text = self._record(position).decode('utf-8-sig').rstrip('\r')
+        return next(csv.reader(io.StringIO(text, newline='')), [])
+
+    def _parse_json_object(self, position):
+        return json.loads(self._record(position).decode('utf-8'))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        if self.file_format == 'csv':
+            return self._parse_csv(index)
+        row = self._parse_json_object(index)
+        return [row.get(name) for name in self.header]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
 class MetabaseTable(object):
     def __init__(self):
         self.status = None
         self.native_query = None
         self.columns = []
         self.rows = []
+        self.cols = []
         self.database = None
+        self.converters = {}
+        self._converted_columns = {}
+        # set on merged tables: index of the source query of every row
+        self.sources = None
+        self.queries = None
+
+    @staticmethod
+    def open(path, file_format=None):
+        """ Table over a file written by DatasetCommand.export, rows are
+        read from a memory map only when accessed.
+
+        :param file_format: 'csv' or 'json', taken from the extension when
+            not given
+        """
+        rows = MappedRows(path=path, file_format=file_format)
+        table = MetabaseTable()
+        table.rows = rows
+        table.columns = list(rows.header or [])
+        table.cols = [{'name': name} for name in table.columns]
+        return table
+
+    def close(self):
+        """ Release the file behind a table opened with MetabaseTable.open,
+        or the spill file of a table with spilled rows. """
+        close = getattr(self.rows, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @property
     def column_count(self):
@@ -27,6 +387,45 @@ class MetabaseTable(object):
     def row_count(self):
         return len(self.rows)
 
+    def column_index(self, column):
+        if isinstance(column, int):
+            return column
+        for index, col in enumerate(self.cols):
+            if col.get('name') == column:
+                return index
+        raise KeyError(column)
+
+    def column(self, column):
+        """ Values of a single column, converted on first access when the
+        table was parsed with lazy conversion. """
+        index = self.column_index(column)
+        if index in self._converted_columns:
+            return self._converted_columns[index]
+        if isinstance(self.rows, ColumnRows) and index not in self.converters:
+            # already stored as a column
+            return self.rows.columns[index]
+        values = [row[index] for row in self.rows]
+        converter = self.converters.get(index)
+        if converter is not None:
+            values = convert_column(values, converter)
+            self._converted_columns[index] = values
+        return values
+
+    def to_columns(self):
+        """ Dict of column name to its values. """
+        return {col.get('name'): self.column(index)
+                for index, col in enumerate(self.cols)}
+
+    def iter_rows(self, columns=None):
+        """ Iterate over rows, optionally keeping only the given columns. """
+        if columns is None:
+            for row in self.rows:
+                yield row
+            return
+        indexes = [self.column_index(column) for column in columns]
+        for row in self.rows:
+            yield [row[index] for index in indexes]
+
 
 class MetabaseTableParser(object):
     @staticmethod
@@ -60,7 +459,36 @@ class MetabaseTableParser(object):
             raise MetabaseResultInvalidException()
 
     @staticmethod
-    def get_table(metabase_response):
+    def resolve_converters(cols, converters):
+        """ Map column indexes to converter callables.
+
+        converters may be keyed by column name or by metabase base_type,
+        names take precedence. Passing True uses DEFAULT_CONVERTERS. """
+        if converters is True:
+            converters = DEFAULT_CONVERTERS
+        resolved = {}
+        for index, col in enumerate(cols):
+            converter = converters.get(col.get('name'))
+            if converter is None:
+                converter = converters.get(col.get('base_type'))
+            if converter is not None:
+                resolved[index] = converter
+        return resolved
+
+    @staticmethod
+    def get_table(metabase_response, converters=None, lazy=False,
+                  max_memory_rows=None):
+        """
+        :param metabase_response: json response of a dataset or card query
+        :param converters: dict of column name / base_type to callable, or
+            True to convert with DEFAULT_CONVERTERS
+        :param lazy: convert columns only when read via MetabaseTable.column
+        :param max_memory_rows: keep at most this many rows in memory and
+            spill the rest to a temporary file. The response already holds
+            every row, so this bounds what the table keeps afterwards, not
+            the peak memory use
+        :return: MetabaseTable
+        """
         MetabaseTableParser.validate_metabase_response(metabase_response)
 
         table = MetabaseTable()
@@ -71,4 +499,61 @@ class MetabaseTableParser(object):
         table.status = metabase_response['status']
         table.database = metabase_response['json_query']['database']
 
+        if converters:
+            table.converters = MetabaseTableParser.resolve_converters(
+                cols=table.cols, converters=converters)
+            if not lazy and table.converters and table.rows:
+                columns = [table.column(index)
+                           for index in range(len(table.cols))]
+                table.rows = [list(row) for row in zip(*columns)]
+                table._converted_columns = {}
+                table.converters = {}
+
+        if max_memory_rows is not None:
+            table.rows = SpillingRows(max_memory_rows=max_memory_rows,
+                                      rows=table.rows)
+
         return table
+
+    @staticmethod
+    def merge_tables(metabase_responses, queries=None):
+        """ Concatenate the results of queries sharing the same columns.
+
+        :param metabase_responses: responses in the order they should be
+            merged
+        :param queries: optional (database_id, query) pair of each response
+        :return: MetabaseTable storing its values column by column, whose
+            sources list holds, for every row, the index of the response it
+            came from
+        """
+        tables = [MetabaseTableParser.get_table(response)
+                  for response in metabase_responses]
+        if not tables:
+            raise MetabaseResultInvalidException("nothing to merge")
+
+        def schema(table):
+            return [(col.get('name'), col.get('base_type'))
+                    for col in table.cols]
+
+        expected_schema = schema(tables[0])
+        for index, table in enumerate(tables[1:], 1):
+            if schema(table) != expected_schema:
+                raise MetabaseResultInvalidException(
+                    "columns of result {} do not match the first "
+                    "result".format(index))
+
+        merged = MetabaseTable()
+        merged.cols = tables[0].cols
+        merged.status = tables[0].status
+        merged.native_query = [table.native_query for table in tables]
+        merged.database = [table.database for table in tables]
+        merged.queries = list(queries) if queries is not None else None
+        columns = [[] for _ in merged.cols]
+        merged.sources = array('l')
+        for index, table in enumerate(tables):
+            for position, values in enumerate(columns):
+                values.extend(row[position] for row in table.rows)
+            merged.sources.extend([index] * len(table.rows))
+        merged.rows = ColumnRows(columns=columns,
+                                 row_count=len(merged.sources))
+        return merged
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+""" Small helpers shared by the metabasepy modules. """
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of an already sorted list, None if empty. """
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]